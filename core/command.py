@@ -1,8 +1,17 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+from collections import deque
+from operator import itemgetter
+from typing import Deque, List, Dict, Any
 from PyQt5.QtGui import QColor
 import fitz
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Field extractors for histories saved before the compact format
+_RECT_KEYS = itemgetter('x0', 'y0', 'x1', 'y1')
+_COLOR_KEYS = itemgetter('r', 'g', 'b', 'a')
 
 class Command(ABC):
     @abstractmethod
@@ -27,7 +36,9 @@ class Command(ABC):
 class HighlightCommand(Command):
     def __init__(self, pdf_doc, rects: List[fitz.Rect], page_num: int, color: QColor):
         self.pdf_doc = pdf_doc
-        self.rects = rects  # Now a list of rectangles
+        # Plain (x0, y0, x1, y1) tuples; fitz.Rect objects are only built
+        # by the document when the highlights are actually added
+        self.rects = [tuple(rect) for rect in rects]
         self.page_num = page_num
         self.color = color
         self.annotation_indices = []  # List of indices for all annotations
@@ -36,19 +47,17 @@ class HighlightCommand(Command):
     def execute(self):
         """Add the highlight annotations"""
         if self.removed_annotations:
-            # Restore removed annotations
-            for idx, annotation in zip(self.annotation_indices, self.removed_annotations):
-                if idx is not None and idx <= len(self.pdf_doc.annotations):
-                    self.pdf_doc.annotations.insert(idx, annotation)
-                else:
-                    self.pdf_doc.annotations.append(annotation)
-                    idx = len(self.pdf_doc.annotations) - 1
-            self.removed_annotations = []
+            # Restore removed annotations, recording where each one landed.
+            # Both lists are updated in place so repeated undo/redo cycles
+            # reuse the same containers and annotation objects.
+            indices = self.annotation_indices
+            for i, annotation in enumerate(self.removed_annotations):
+                indices[i] = self.pdf_doc.insert_annotation(indices[i], annotation)
+            self.removed_annotations.clear()
         else:
             # Add new highlights
-            for rect in self.rects:
-                self.pdf_doc.add_highlight(rect, self.page_num, self.color)
-                self.annotation_indices.append(len(self.pdf_doc.annotations) - 1)
+            self.annotation_indices = self.pdf_doc.add_highlights(
+                self.rects, self.page_num, self.color)
         return True
         
     def undo(self):
@@ -57,58 +66,54 @@ class HighlightCommand(Command):
             return False
             
         # Remove annotations in reverse order to maintain correct indices
-        self.removed_annotations = []
+        self.removed_annotations.clear()
         for idx in reversed(self.annotation_indices):
             if 0 <= idx < len(self.pdf_doc.annotations):
-                self.removed_annotations.insert(0, self.pdf_doc.annotations[idx])
+                self.removed_annotations.append(self.pdf_doc.annotations[idx])
                 if not self.pdf_doc.remove_annotation(idx):
+                    self.removed_annotations.reverse()
                     return False
+        # Collected back-to-front; flip once so they pair with annotation_indices
+        self.removed_annotations.reverse()
         return True
         
     def to_dict(self) -> Dict[str, Any]:
         """Convert command to a serializable dictionary"""
+        color = self.color
         return {
             'type': 'highlight',
-            'rects': [{
-                'x0': rect.x0,
-                'y0': rect.y0,
-                'x1': rect.x1,
-                'y1': rect.y1
-            } for rect in self.rects],
-            'page_num': self.page_num,
-            'color': {
-                'r': self.color.red(),
-                'g': self.color.green(),
-                'b': self.color.blue(),
-                'a': self.color.alpha()
-            },
-            'annotation_indices': self.annotation_indices
+            'r': [list(rect) for rect in self.rects],
+            'p': self.page_num,
+            'c': [color.red(), color.green(), color.blue(), color.alpha()],
+            'i': self.annotation_indices
         }
         
     @classmethod
     def from_dict(cls, data: Dict[str, Any], pdf_doc):
         """Create command instance from dictionary"""
-        rects = [fitz.Rect(
-            rect_dict['x0'],
-            rect_dict['y0'],
-            rect_dict['x1'],
-            rect_dict['y1']
-        ) for rect_dict in data['rects']]
-        
-        color = QColor(
-            data['color']['r'],
-            data['color']['g'],
-            data['color']['b'],
-            data['color']['a']
-        )
+        if 'rects' in data:
+            return cls._from_legacy_dict(data, pdf_doc)
+            
+        c = data['c']
+        command = cls(pdf_doc, data['r'], data['p'], QColor(c[0], c[1], c[2], c[3]))
+        command.annotation_indices = data.get('i', [])
+        return command
+        
+    @classmethod
+    def _from_legacy_dict(cls, data: Dict[str, Any], pdf_doc):
+        """Create command instance from the older named-key format"""
+        # itemgetter pulls all four keys in one C-level call per rect
+        rects = list(map(_RECT_KEYS, data['rects']))
+        color = QColor(*_COLOR_KEYS(data['color']))
         command = cls(pdf_doc, rects, data['page_num'], color)
         command.annotation_indices = data.get('annotation_indices', [])
         return command
 
 class CommandHistory:
     def __init__(self, max_stack_size: int = 100):
-        self.undo_stack: List[Command] = []
-        self.redo_stack: List[Command] = []
+        # Bounded deques drop the oldest command on append once full
+        self.undo_stack: Deque[Command] = deque(maxlen=max_stack_size)
+        self.redo_stack: Deque[Command] = deque(maxlen=max_stack_size)
         self.max_stack_size = max_stack_size
         
     def will_lose_redo_history(self) -> bool:
@@ -119,12 +124,9 @@ class CommandHistory:
         """Execute a new command and add it to history"""
         if command.execute():
             self.undo_stack.append(command)
-            # If we exceed max size, remove oldest command
-            if len(self.undo_stack) > self.max_stack_size:
-                self.undo_stack.pop(0)
             # Clear redo stack as we're creating a new history branch
             if self.redo_stack:
-                print("Note: Cleared redo history as new action was performed")
+                logger.debug("Cleared redo history as new action was performed")
             self.redo_stack.clear()
             return True
         return False
@@ -137,9 +139,6 @@ class CommandHistory:
         command = self.undo_stack.pop()
         if command.undo():
             self.redo_stack.append(command)
-            # If we exceed max size, remove oldest command
-            if len(self.redo_stack) > self.max_stack_size:
-                self.redo_stack.pop(0)
             return True
         return False
         
@@ -151,9 +150,6 @@ class CommandHistory:
         command = self.redo_stack.pop()
         if command.execute():
             self.undo_stack.append(command)
-            # If we exceed max size, remove oldest command
-            if len(self.undo_stack) > self.max_stack_size:
-                self.undo_stack.pop(0)
             return True
         return False
         
@@ -172,17 +168,19 @@ class CommandHistory:
         
     def load_from_dict(self, data: Dict[str, Any], pdf_doc):
         """Load command history from dictionary"""
-        self.clear()
         self.max_stack_size = data.get('max_stack_size', 100)
-        
-        # Reconstruct undo stack
-        for cmd_data in data.get('undo_stack', []):
-            if cmd_data['type'] == 'highlight':
-                command = HighlightCommand.from_dict(cmd_data, pdf_doc)
-                self.undo_stack.append(command)
-                
-        # Reconstruct redo stack
-        for cmd_data in data.get('redo_stack', []):
-            if cmd_data['type'] == 'highlight':
-                command = HighlightCommand.from_dict(cmd_data, pdf_doc)
-                self.redo_stack.append(command) 
\ No newline at end of file
+        self.undo_stack = deque(maxlen=self.max_stack_size)
+        self.redo_stack = deque(maxlen=self.max_stack_size)
+        
+        # Reconstruct both stacks, skipping command types we don't know
+        for stack, key in ((self.undo_stack, 'undo_stack'), (self.redo_stack, 'redo_stack')):
+            for cmd_data in data.get(key, []):
+                ctor = _CMD_CTORS.get(cmd_data.get('type'))
+                if ctor:
+                    stack.append(ctor(cmd_data, pdf_doc))
+
+
+# Maps a serialized command 'type' to the constructor that rebuilds it
+_CMD_CTORS = {
+    'highlight': HighlightCommand.from_dict,
+} 
\ No newline at end of file
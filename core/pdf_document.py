@@ -1,87 +1,273 @@
 import fitz  # PyMuPDF
+import logging
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional, Tuple
 from PyQt5.QtGui import QColor
 
+logger = logging.getLogger(__name__)
+
+HIGHLIGHT_TYPE = fitz.PDF_ANNOT_HIGHLIGHT
+
+_WORD_RE = re.compile(r'\w+')
+# A hyphen ending a line; page.search_for joins the word across it
+_LINE_HYPHEN_RE = re.compile(r'-\n')
+
+# PyMuPDF does not support concurrent use from several threads, even on
+# separate documents, so every fitz call made off the GUI thread, and
+# every GUI-thread call that may overlap one, holds this lock
+fitz_lock = threading.RLock()
+
+@dataclass(slots=True, eq=False)
+class Annotation:
+    """A single annotation on a page, kept small since documents hold many"""
+    type: str
+    rect: fitz.Rect
+    page: int
+    color: QColor
+    rgb: Tuple[float, float, float]  # 0-1 stroke colour for PyMuPDF
+    xref: Optional[int] = None  # xref of the backing fitz annotation
+    materialized: bool = False  # True while a fitz annotation backs it
+
+def extract_page_spans(page):
+    """Return a page's text spans as (bboxes, texts, char_x)"""
+    bboxes = array('d')
+    texts = []
+    char_x = array('d')
+    for block in page.get_text("rawdict")["blocks"]:
+        # Image blocks have no lines
+        for line in block.get("lines", ()):
+            for span in line["spans"]:
+                chars = span["chars"]
+                if not chars:
+                    continue
+                bboxes.extend(span["bbox"])
+                texts.append(''.join(char["c"] for char in chars))
+                char_x.extend(char["bbox"][0] for char in chars)
+    return bboxes, texts, char_x
+
 class PDFDocument:
     def __init__(self):
         self.doc = None
-        self.annotations = []
+        self.page_rects = []  # Unzoomed rect of each page, read once on open
+        self.annotations = []  # Global order, indexed by HighlightCommand
+        self.annotations_by_page = defaultdict(list)  # page_num -> annotations
+        self._dirty_pages = set()  # Pages whose highlights changed since last applied
         self.page_text_data = []
+        self._page_spans = []  # Unscaled span layout per page, filled on demand
+        self.word_index = None  # word -> set of page numbers, built on demand
+        self.cache_key = ""  # Identifies the opened file's contents for caches
         
     def open(self, path):
         """Open a PDF document and process its text data"""
         try:
-            self.doc = fitz.open(path)
+            with fitz_lock:
+                # Naming the type skips MuPDF's format sniffing
+                doc = fitz.open(path, filetype="pdf")
+                # Read here, so laying out pages at a new zoom never waits
+                # for fitz_lock while a page is being rendered
+                page_rects = [page.rect for page in doc]
+            stat = os.stat(path)
+            # Drop the previous document and its annotations only once the
+            # new one has opened
+            self.close()
+            self.doc = doc
+            self.page_rects = page_rects
+            # Path, size and mtime change whenever the file does, without
+            # reading it through a hash
+            self.cache_key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
             self.process_text_data()
             return True
-        except Exception as e:
-            print(f"Error opening PDF: {e}")
+        except Exception:
+            logger.exception("Error opening PDF")
             return False
             
     def process_text_data(self):
-        """Extract text from all pages"""
+        """Reset the per-page text cache; pages are extracted on first access"""
         if not self.doc:
             return
             
-        self.page_text_data = []
-        for page in self.doc:
-            text = page.get_text()
-            self.page_text_data.append(text)
+        with fitz_lock:
+            page_count = self.doc.page_count
+        self.page_text_data = [None] * page_count
+        self._page_spans = [None] * page_count
+        self.word_index = None
+        
+    def get_page_text(self, page_num):
+        """Return the text layer of a page, extracting it on first use"""
+        text = self.page_text_data[page_num]
+        if text is None:
+            with fitz_lock:
+                text = self.doc[page_num].get_text()
+            self.page_text_data[page_num] = text
+        return text
+        
+    def cached_page_spans(self, page_num):
+        """Return a page's extracted text spans, or None if not extracted yet"""
+        return self._page_spans[page_num]
+        
+    def store_page_spans(self, page_num, spans):
+        """Keep spans extracted by extract_page_spans for a page"""
+        if self._page_spans[page_num] is None:
+            self._page_spans[page_num] = spans
+        
+    def candidate_pages(self, query):
+        """Return the pages that may contain a lowercased query, in order"""
+        if self.word_index is None:
+            self._build_word_index()
+            
+        vocab, starts, vocab_pages = self._vocab, self._vocab_starts, self._vocab_pages
+        pages = None
+        for token in _WORD_RE.findall(query):
+            # Tokens never contain the newline separator, so each find hit
+            # lies inside a single vocabulary word
+            matching = set()
+            pos = vocab.find(token)
+            while pos >= 0:
+                i = bisect_right(starts, pos) - 1
+                matching |= vocab_pages[i]
+                if i + 1 == len(starts):
+                    break
+                # One hit per word is enough; resume at the next word
+                pos = vocab.find(token, starts[i + 1])
+            pages = matching if pages is None else pages & matching
+            if not pages:
+                return []
+                
+        if pages is None:
+            # No word characters to look up; every page is a candidate
+            return list(range(len(self.page_text_data)))
+        return sorted(pages)
+        
+    def _build_word_index(self):
+        """Index which pages each lowercased word appears on"""
+        index = defaultdict(set)
+        for page_num in range(len(self.page_text_data)):
+            text = self.get_page_text(page_num)
+            words = set(_WORD_RE.findall(text))
+            # search_for dehyphenates, so "infor-" + "mation" must also be
+            # indexed as "information"
+            if '-\n' in text:
+                words.update(_WORD_RE.findall(_LINE_HYPHEN_RE.sub('', text)))
+            # Lowercase each distinct word, not a full copy of the page
+            for word in words:
+                index[word.lower()].add(page_num)
+        self.word_index = dict(index)
+        
+        words = list(self.word_index)
+        self._vocab = '\n'.join(words)
+        self._vocab_pages = [self.word_index[word] for word in words]
+        self._vocab_starts = []  # Offset of each word in _vocab
+        offset = 0
+        for word in words:
+            self._vocab_starts.append(offset)
+            offset += len(word) + 1
             
     def add_highlight(self, rect, page_num, color):
         """Add a highlight annotation"""
-        if not isinstance(rect, fitz.Rect):
-            rect = fitz.Rect(rect)
-            
-        # Add some padding
-        rect.x0 -= 1
-        rect.x1 += 1
-        
-        annotation = {
-            'type': 'highlight',
-            'rect': rect,
-            'page': page_num,
-            'color': color
-        }
+        annotation = self._make_highlight(rect, page_num, color, color.getRgbF()[:3])
         self.annotations.append(annotation)
+        self.annotations_by_page[page_num].append(annotation)
+        self._dirty_pages.add(page_num)
+        
+    def add_highlights(self, rects, page_num, color):
+        """Add one highlight per rect on a page, returning their indices"""
+        rgb = color.getRgbF()[:3]
+        new_annotations = [self._make_highlight(rect, page_num, color, rgb) for rect in rects]
+        
+        # One extend per list sizes each backing array once for the batch
+        start = len(self.annotations)
+        self.annotations.extend(new_annotations)
+        self.annotations_by_page[page_num].extend(new_annotations)
+        self._dirty_pages.add(page_num)
+        return list(range(start, start + len(new_annotations)))
+        
+    @staticmethod
+    def _make_highlight(rect, page_num, color, rgb):
+        """Build a padded highlight annotation; rgb is the 0-1 stroke colour"""
+        # Build a padded copy in one go rather than mutating the caller's rect;
+        # unpacking accepts both fitz.Rect and plain (x0, y0, x1, y1) tuples
+        x0, y0, x1, y1 = rect
+        rect = fitz.Rect(x0 - 1, y0, x1 + 1, y1)
+        return Annotation('highlight', rect, page_num, color, rgb)
+        
+    def insert_annotation(self, index, annotation):
+        """Re-insert a previously removed annotation, returning its index"""
+        if index is None or index > len(self.annotations):
+            index = len(self.annotations)
+        self.annotations.insert(index, annotation)
+        self.annotations_by_page[annotation.page].append(annotation)
+        self._dirty_pages.add(annotation.page)
+        return index
+        
+    def _unindex_annotation(self, annotation):
+        """Drop an annotation from its page bucket (matched by identity)"""
+        bucket = self.annotations_by_page.get(annotation.page)
+        if not bucket:
+            return
+        for i, ann in enumerate(bucket):
+            if ann is annotation:
+                del bucket[i]
+                break
+        if not bucket:
+            del self.annotations_by_page[annotation.page]
         
     def remove_annotation(self, index):
         """Remove an annotation by index"""
         if 0 <= index < len(self.annotations):
             try:
                 # Get the page number BEFORE removing the annotation
-                page_num = self.annotations[index]['page']
+                page_num = self.annotations[index].page
                 annotation = self.annotations.pop(index)
+                self._unindex_annotation(annotation)
+                # A duplicate left pending by _apply_bulk may now need writing
+                self._dirty_pages.add(page_num)
                 
-                # Clear any existing highlights on the page
-                if self.doc:
-                    page = self.doc[page_num]
-                    for annot in page.annots():
-                        if annot.type[0] == 8:  # Highlight annotation
-                            page.delete_annot(annot)
+                # Delete only the PDF annotation that backs this entry
+                xref = annotation.xref
+                if self.doc and xref:
+                    with fitz_lock:
+                        page = self.doc[page_num]
+                        # annot_xrefs() is listed by the C layer; checking it
+                        # first keeps a stale xref from raising in load_annot
+                        if any(entry[0] == xref and entry[1] == HIGHLIGHT_TYPE
+                               for entry in page.annot_xrefs()):
+                            page.delete_annot(page.load_annot(xref))
+                annotation.xref = None
+                annotation.materialized = False
                 return True
-            except Exception as e:
-                print(f"Error removing annotation: {e}")
+            except Exception:
+                logger.exception("Error removing annotation")
                 # If something went wrong, try to restore the annotation
                 if 'annotation' in locals():
-                    self.annotations.insert(index, annotation)
+                    self.insert_annotation(index, annotation)
                 return False
         return False
         
-    def apply_highlights(self, page_num):
-        """Apply highlights to a specific page"""
-        if not self.doc:
+    def _apply_bulk(self, page_num, annotations):
+        """Materialize every pending highlight of one page in a single pass"""
+        pending = [ann for ann in annotations
+                   if ann.type == 'highlight' and not ann.materialized]
+        if not pending:
             return
             
-        page = self.doc[page_num]
-        page_highlights = [ann for ann in self.annotations if ann['page'] == page_num]
-        
-        for highlight in page_highlights:
-            if highlight['type'] == 'highlight':
-                color = highlight['color']
-                rgb = (color.red()/255, color.green()/255, color.blue()/255)
-                annot = page.add_highlight_annot(highlight['rect'])
-                annot.set_colors(stroke=rgb)
-                annot.update()
+        applied = {(tuple(ann.rect), ann.rgb) for ann in annotations if ann.materialized}
+        add_highlight_annot = self.doc[page_num].add_highlight_annot
+        for annotation in pending:
+            key = (tuple(annotation.rect), annotation.rgb)
+            if key in applied:
+                continue
+            applied.add(key)
+            annot = add_highlight_annot(annotation.rect)
+            annot.set_colors(stroke=annotation.rgb)
+            annot.update()
+            annotation.xref = annot.xref
+            annotation.materialized = True
                 
     def save(self, save_path):
         """Save the document with all annotations"""
@@ -89,32 +275,38 @@ class PDFDocument:
             return False
             
         try:
-            # Apply all annotations
-            for annotation in self.annotations:
-                if annotation['type'] == 'highlight':
-                    page = self.doc[annotation['page']]
-                    color = annotation['color']
-                    rgb = (color.red()/255, color.green()/255, color.blue()/255)
-                    highlight = page.add_highlight_annot(annotation['rect'])
-                    highlight.set_colors(stroke=rgb)
-                    highlight.update()
-            
-            # Save with optimization
-            self.doc.save(
-                save_path,
-                garbage=4,
-                deflate=True,
-                pretty=False
-            )
+            with fitz_lock:
+                # Apply all annotations not yet written to the document,
+                # visiting only pages whose highlights changed since the last save
+                for page_num in self._dirty_pages:
+                    page_annotations = self.annotations_by_page.get(page_num)
+                    if page_annotations:
+                        self._apply_bulk(page_num, page_annotations)
+                self._dirty_pages.clear()
+                
+                # Save with optimization
+                self.doc.save(
+                    save_path,
+                    garbage=4,
+                    deflate=True,
+                    pretty=False
+                )
             return True
-        except Exception as e:
-            print(f"Error saving PDF: {e}")
+        except Exception:
+            logger.exception("Error saving PDF")
             return False
             
     def close(self):
         """Close the document"""
         if self.doc:
-            self.doc.close()
+            with fitz_lock:
+                self.doc.close()
             self.doc = None
+            self.page_rects = []
             self.annotations = []
-            self.page_text_data = [] 
\ No newline at end of file
+            self.annotations_by_page.clear()
+            self._dirty_pages.clear()
+            self.page_text_data = []
+            self._page_spans = []
+            self.word_index = None
+            self.cache_key = "" 
\ No newline at end of file
@@ -2,29 +2,76 @@ from email.mime import application
 from PyQt5.QtWidgets import (QMainWindow, QAction, QFileDialog, QScrollArea, 
                             QToolBar, QStyle, QWidget, QVBoxLayout, QComboBox,
                             QColorDialog, QLineEdit, QApplication, QMessageBox, QCheckBox)
-from PyQt5.QtGui import QImage, QPixmap, QColor
-from PyQt5.QtCore import Qt, QSettings
+from PyQt5.QtGui import QPixmap, QPixmapCache, QColor
+from PyQt5.QtCore import Qt, QSettings, QStandardPaths, QThreadPool, QRectF, QTimer
 import fitz
+import hashlib
 import json
+import logging
 import os
 
-from core.pdf_document import PDFDocument
+from core.pdf_document import PDFDocument, fitz_lock
 from core.command import CommandHistory, HighlightCommand
 from ui.pdf_display_widget import PDFDisplayWidget
-from utils.ocr_handler import OCRHandler
+from ui.page_renderer import PageRenderTask, PageTextTask, RenderSignals
+
+logger = logging.getLogger(__name__)
+
+# Files bigger than this are only reopened on startup after asking
+_RESUME_PROMPT_BYTES = 20 * 1024 * 1024
+
+def _sidecar_paths(pdf_path):
+    """Return the sidecar path next to a PDF and its app-data fallback"""
+    beside = os.path.splitext(pdf_path)[0] + ".annot.json"
+    app_data = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+    name = hashlib.sha1(os.path.abspath(pdf_path).encode("utf-8")).hexdigest()
+    return beside, os.path.join(app_data, "sessions", name + ".annot.json")
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.pdf_doc = PDFDocument()
-        self.ocr = OCRHandler()
         self.selected_text = ""
         self.page_widgets = []  # Store our custom page widgets
+        self._rendered_pages = set()  # Pages whose pixmap and text are loaded
+        # Rasterization runs on a dedicated thread pool; results from an older
+        # render generation (previous zoom or document) are dropped. PyMuPDF
+        # calls are serialized by fitz_lock, so more than one thread would
+        # only open more copies of the document; the thread never expires,
+        # so it keeps its copy open.
+        self._render_pool = QThreadPool(self)
+        self._render_pool.setMaxThreadCount(1)
+        self._render_pool.setExpiryTimeout(-1)
+        self._render_signals = RenderSignals(self)
+        self._render_signals.finished.connect(self._on_page_rendered)
+        self._render_signals.failed.connect(self._on_page_render_failed)
+        self._render_signals.textReady.connect(self._on_page_text)
+        self._render_signals.textFailed.connect(self._on_page_text_failed)
+        self._render_generation = 0
+        self._pending_renders = set()  # Pages queued on the thread pool
+        self._pending_text = set()  # Pages whose text layout is being built
+        self._prefetch_margin = 600  # Pixels rendered ahead of the viewport
+        self._evict_margin = 3000  # Pages further off-screen drop their pixmap
         self.zoom_level = 1.5  # Default zoom level
         self.highlight_color = QColor(255, 255, 0, 100)  # Default yellow with transparency
         
         self.settings = QSettings("YourCompany", "PDFAnnotator9000")
         
+        # Bare page pixmaps live in Qt's QPixmapCache, keyed by document,
+        # page and zoom; highlights are painted over a copy when shown.
+        # The byte budget can be raised through the cache_mb setting.
+        cache_mb = self.settings.value("cache_mb", 256, type=int)
+        QPixmapCache.setCacheLimit(cache_mb * 1024)  # In KB
+        
+        # Annotations and history are written in the background when they
+        # change, so closing the window only has to write what is left
+        self._session_dirty = False
+        self._legacy_session = False  # Restored from old QSettings keys
+        self._save_timer = QTimer(self)
+        self._save_timer.setInterval(5000)
+        self._save_timer.timeout.connect(self._flush_session)
+        self._save_timer.start()
+        
         self.search_results = []
         self.current_search_index = -1
         self.search_highlight_color = QColor(0, 255, 0, 60)  # Green highlight
@@ -58,6 +105,11 @@ class MainWindow(QMainWindow):
         self.scroll_area.setWidget(self.container)
         self.setCentralWidget(self.scroll_area)
         
+        # Pages are rasterized as they scroll into view
+        scroll_bar = self.scroll_area.verticalScrollBar()
+        scroll_bar.valueChanged.connect(self._ensure_visible_pages)
+        scroll_bar.rangeChanged.connect(self._ensure_visible_pages)
+        
         # Create toolbar with object name
         toolbar = QToolBar("Main Toolbar")  # Added name in constructor
         toolbar.setObjectName("mainToolbar")  # Set object name for state saving
@@ -157,77 +209,193 @@ class MainWindow(QMainWindow):
     def open_pdf(self):
         path, _ = QFileDialog.getOpenFileName(self, "Open PDF", "", "PDF Files (*.pdf)")
         if path:
+            # Write out the current document's changes before leaving it
+            self._flush_session()
             if self.pdf_doc.open(path):
-                # Clear command history when opening new document
+                # Clear command history of the old document
                 self.command_history.clear()
+                self._restore_session(path)
+                self.settings.setValue("last_file", path)
                 self.update_undo_redo_actions()
                 self.render_pdf()
     
     def render_pdf(self):
-        """Render all PDF pages into the scrollable view"""
+        """Lay out placeholders for all PDF pages and render the visible ones"""
         if not self.pdf_doc.doc:
             return
             
-        # Clear existing pages
-        for widget in self.page_widgets:
-            widget.deleteLater()
-        self.page_widgets.clear()
-        
         # Get the container layout
         layout = self.container.layout()
         
-        # Render each page
-        mat = fitz.Matrix(self.zoom_level, self.zoom_level)
-        
-        for page_num in range(len(self.pdf_doc.doc)):
-            page = self.pdf_doc.doc[page_num]
-            
-            # Apply highlights for this page
-            self.pdf_doc.apply_highlights(page_num)
-            
-            # Get page pixmap
-            pix = page.get_pixmap(matrix=mat)
-            
-            # Convert pixmap to QImage
-            img = QImage(pix.samples, pix.width, pix.height, pix.stride, QImage.Format_RGB888)
-            
-            # Create custom widget for this page
-            page_widget = PDFDisplayWidget(page_num=page_num)
-            page_widget.setAlignment(Qt.AlignCenter)
-            page_widget.setPixmap(QPixmap.fromImage(img))
-            
-            # Extract text blocks and their positions
-            text_blocks = []
-            for block in page.get_text("dict")["blocks"]:
-                if "lines" in block:
-                    for line in block["lines"]:
-                        if "spans" in line:
-                            for span in line["spans"]:
-                                # Convert PDF coordinates to screen coordinates
-                                rect = span["bbox"]
-                                # Apply zoom and ensure coordinates are within widget bounds
-                                scaled_rect = {
-                                    'x': max(0, rect[0] * self.zoom_level),
-                                    'y': max(0, rect[1] * self.zoom_level),
-                                    'width': max(1, (rect[2] - rect[0]) * self.zoom_level),
-                                    'height': max(1, (rect[3] - rect[1]) * self.zoom_level)
-                                }
-                                text_blocks.append({
-                                    'text': span["text"],
-                                    'rect': scaled_rect
-                                })
-            
-            # Set text blocks for the page widget
-            page_widget.set_text_blocks(text_blocks)
-            
-            # Add to layout
-            layout.addWidget(page_widget)
-            self.page_widgets.append(page_widget)
+        # Hold back repaints while widgets are added, removed and resized;
+        # the view is repainted once afterwards instead of once per page
+        self.container.setUpdatesEnabled(False)
+        self.scroll_area.setUpdatesEnabled(False)
+        try:
+            # Reuse the existing page widgets when the page count is unchanged,
+            # otherwise rebuild them
+            # Page sizes were read on open, so this never waits on a render
+            page_rects = self.pdf_doc.page_rects
+            page_count = len(page_rects)
+            reuse_widgets = len(self.page_widgets) == page_count
+            if not reuse_widgets:
+                # Take the old widgets out of the layout before deleting them
+                while layout.count():
+                    widget = layout.takeAt(0).widget()
+                    if widget is not None:
+                        widget.setParent(None)
+                        widget.deleteLater()
+                self.page_widgets.clear()
+            self._rendered_pages.clear()
+            self._render_generation += 1
+            self._pending_renders.clear()
+            self._pending_text.clear()
+            self._render_pool.clear()  # Queued renders of the old layout
+            
+            zoom = self.zoom_level
+            for page_num, rect in enumerate(page_rects):
+                if not reuse_widgets:
+                    # Create custom widget for this page
+                    page_widget = PDFDisplayWidget(page_num=page_num)
+                    page_widget.setAlignment(Qt.AlignCenter)
+                    page_widget.textSelected.connect(self.handle_text_selection)
+                    page_widget.renderRequested.connect(self._render_single_page)
+                    layout.addWidget(page_widget)
+                    self.page_widgets.append(page_widget)
+                    
+                page_widget = self.page_widgets[page_num]
+                page_widget.clear_page_image()
+                page_widget.clear_text()
+                page_widget.setFixedSize(int(rect.width * zoom), int(rect.height * zoom))
+                
+            # Place the widgets now so the visible ones can be found
+            layout.activate()
+        finally:
+            self.container.setUpdatesEnabled(True)
+            self.scroll_area.setUpdatesEnabled(True)
+            self.scroll_area.viewport().update()
+            
+        self._ensure_visible_pages()
             
         # Update window title
-        total_pages = len(self.pdf_doc.doc)
-        self.setWindowTitle(f'PDF Annotator 9000 - {total_pages} pages')
-    
+        self.setWindowTitle(f'PDF Annotator 9000 - {page_count} pages')
+        
+    def _ensure_visible_pages(self, *_):
+        """Render the pages within the viewport plus a prefetch margin"""
+        if not self.pdf_doc.doc or not self.page_widgets:
+            return
+            
+        scroll_pos = self.scroll_area.verticalScrollBar().value()
+        viewport_bottom = scroll_pos + self.scroll_area.viewport().height()
+        top = scroll_pos - self._prefetch_margin
+        bottom = viewport_bottom + self._prefetch_margin
+        
+        for page_num, page_widget in enumerate(self.page_widgets):
+            geometry = page_widget.geometry()
+            if page_num in self._rendered_pages:
+                if (geometry.bottom() < scroll_pos - self._evict_margin
+                        or geometry.top() > viewport_bottom + self._evict_margin):
+                    self._rendered_pages.discard(page_num)
+                    page_widget.clear_page_image()
+                continue
+            if geometry.bottom() < top or geometry.top() > bottom:
+                continue
+            self._rendered_pages.add(page_num)
+            self._render_single_page(page_num)
+            self._load_page_text(page_num)
+            
+    def _load_page_text(self, page_num):
+        """Give a page widget its text layout at the current zoom"""
+        spans = self.pdf_doc.cached_page_spans(page_num)
+        if spans is not None:
+            self.page_widgets[page_num].set_text_blocks(*spans, self.zoom_level)
+            return
+        if page_num in self._pending_text:
+            return
+        self._pending_text.add(page_num)
+        task = PageTextTask(self._render_signals, self.pdf_doc.doc.name, self.pdf_doc.cache_key,
+                            page_num, self.zoom_level, self._render_generation)
+        self._render_pool.start(task)
+        
+    def _on_page_text(self, generation, page_num, spans, layout):
+        """Keep a page's extracted spans and install its text layout"""
+        if generation != self._render_generation:
+            return
+            
+        self._pending_text.discard(page_num)
+        self.pdf_doc.store_page_spans(page_num, spans)
+        if page_num in self._rendered_pages:
+            self.page_widgets[page_num].set_text_layout(layout)
+            
+    def _on_page_text_failed(self, generation, page_num):
+        """Let a page whose text extraction failed be requested again"""
+        if generation == self._render_generation:
+            self._pending_text.discard(page_num)
+        
+    def _render_single_page(self, page_num):
+        """Refresh the image of one existing page widget"""
+        if not self.pdf_doc.doc or page_num not in self._rendered_pages:
+            return
+            
+        key = self._page_cache_key(page_num)
+        page_widget = self.page_widgets[page_num]
+        base = QPixmapCache.find(key)
+        if (base is not None and not base.isNull()) or page_widget.holds_page_image(key):
+            page_widget.set_page_image(key, self._page_highlights(page_num))
+            return
+            
+        # Don't queue the same page twice while one render is in flight
+        if page_num in self._pending_renders:
+            return
+        self._pending_renders.add(page_num)
+        task = PageRenderTask(self._render_signals, self.pdf_doc.doc.name, self.pdf_doc.cache_key,
+                              page_num, self.zoom_level, self._render_generation)
+        self._render_pool.start(task)
+        
+    def _on_page_rendered(self, generation, page_num, image):
+        """Cache a finished render and show it with the page's highlights"""
+        if generation != self._render_generation:
+            return
+            
+        key = self._page_cache_key(page_num)
+        pixmap = QPixmap.fromImage(image)
+        # QPixmapCache refuses a pixmap bigger than its whole limit, such as
+        # a large-format page at high zoom. The widget keeps that one itself;
+        # otherwise every paint would miss the cache and render it again.
+        cached = QPixmapCache.insert(key, pixmap)
+            
+        self._pending_renders.discard(page_num)
+        if page_num not in self._rendered_pages:
+            return  # Evicted while the render was in flight
+        self.page_widgets[page_num].set_page_image(key, self._page_highlights(page_num),
+                                                   None if cached else pixmap)
+        
+    def _on_page_render_failed(self, generation, page_num):
+        """Let a page whose render failed be requested again"""
+        if generation == self._render_generation:
+            self._pending_renders.discard(page_num)
+        
+    def _page_cache_key(self, page_num):
+        """QPixmapCache key of a bare page at the current zoom level"""
+        return f"{self.pdf_doc.cache_key}:p{page_num}:z{int(self.zoom_level * 100)}"
+        
+    def _page_highlights(self, page_num):
+        """Return a page's highlights as (QRectF, QColor) pairs at the current zoom"""
+        highlights = []
+        zoom = self.zoom_level
+        # Highlights carry their 0-1 rgb from creation; build one opaque
+        # QColor per distinct colour rather than one per highlight
+        colors = {}
+        for ann in self.pdf_doc.annotations_by_page.get(page_num, ()):
+            color = colors.get(ann.rgb)
+            if color is None:
+                color = colors[ann.rgb] = QColor.fromRgbF(*ann.rgb)
+            rect = ann.rect
+            highlights.append((
+                QRectF(rect.x0 * zoom, rect.y0 * zoom, rect.width * zoom, rect.height * zoom),
+                color))
+        return highlights
+        
     def handle_text_selection(self, text, page_num):
         """Handle text selection from a page widget"""
         self.selected_text = text
@@ -310,147 +478,101 @@ class MainWindow(QMainWindow):
             if not text:
                 return
                 
-            # Find the text in the page's text blocks
-            text_found = False
-            for i, block in enumerate(page_widget.text_blocks):
-                if block['text'] == text[0]:  # Found potential start
-                    # Check if the following characters match
-                    matches = True
-                    for j, char in enumerate(text[1:], 1):
-                        if i + j >= len(page_widget.text_blocks) or page_widget.text_blocks[i + j]['text'] != char:
-                            matches = False
-                            break
-                    
-                    if matches:
-                        # Found the text, set selection indices
-                        page_widget.selection_start = i
-                        page_widget.selection_end = i + len(text) - 1
-                        text_found = True
-                        break
-            
-            if not text_found:
+            # Find the text in the page's joined span text; character
+            # indices into it are the widget's selection indices
+            pos = page_widget.text.find(text)
+            if pos < 0:
                 return
+            page_widget.selection_start = pos
+            page_widget.selection_end = pos + len(text) - 1
         
         # Get selection indices
         start_idx = min(page_widget.selection_start, page_widget.selection_end)
         end_idx = max(page_widget.selection_start, page_widget.selection_end)
         
-        # Get the rectangles for the selected text
-        selected_rects = []
-        current_line = []
-        current_y = None
-        
-        # Group characters by line
-        for i in range(start_idx, end_idx + 1):
-            if i >= len(page_widget.text_blocks):
-                break
-                
-            rect = page_widget.text_blocks[i]['rect']
-            y = int(rect['y'])
-            
-            # If this is a new line or the first character
-            if current_y is None or abs(y - current_y) > rect['height'] * 0.5:
-                # Add the previous line if it exists
-                if current_line:
-                    # Create a single rectangle for the line
-                    x_start = min(r['x'] for r in current_line)
-                    x_end = max(r['x'] + r['width'] for r in current_line)
-                    selected_rects.append(fitz.Rect(
-                        x_start / self.zoom_level,
-                        current_line[0]['y'] / self.zoom_level,
-                        x_end / self.zoom_level,
-                        (current_line[0]['y'] + current_line[0]['height']) / self.zoom_level
-                    ))
-                # Start a new line
-                current_line = [rect]
-                current_y = y
-            else:
-                # Add to current line
-                current_line.append(rect)
-        
-        # Add the last line
-        if current_line:
-            x_start = min(r['x'] for r in current_line)
-            x_end = max(r['x'] + r['width'] for r in current_line)
-            selected_rects.append(fitz.Rect(
-                x_start / self.zoom_level,
-                current_line[0]['y'] / self.zoom_level,
-                x_end / self.zoom_level,
-                (current_line[0]['y'] + current_line[0]['height']) / self.zoom_level
-            ))
+        # One rect per text line, in PDF units. The widget merges whole
+        # span runs into lines, so this loops over lines, not characters.
+        inv_zoom = 1.0 / self.zoom_level
+        selected_rects = [
+            fitz.Rect(x * inv_zoom, y * inv_zoom, (x + width) * inv_zoom, (y + height) * inv_zoom)
+            for x, y, width, height in page_widget.selection_line_rects(start_idx, end_idx)
+        ]
         
         # Create a single command for all rectangles
-        if selected_rects:
-            # Check if we'll lose redo history and if we should show the warning
-            if (self.command_history.will_lose_redo_history() and 
-                not self.settings.value("hide_redo_warning", False, type=bool)):
-                # Create message box with checkbox
-                msg_box = QMessageBox(self)
-                msg_box.setIcon(QMessageBox.Warning)
-                msg_box.setWindowTitle('Warning')
-                msg_box.setText('Creating a new highlight here will clear your redo history.')
-                msg_box.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
-                msg_box.setDefaultButton(QMessageBox.No)
-                
-                # Add checkbox
-                checkbox = QCheckBox("Don't show this warning again")
-                msg_box.setCheckBox(checkbox)
-                
-                reply = msg_box.exec_()
-                
-                # Save checkbox state if user clicked Yes
-                if reply == QMessageBox.Yes and checkbox.isChecked():
-                    self.settings.setValue("hide_redo_warning", True)
-                    self.settings.sync()
-                
-                if reply == QMessageBox.No:
-                    return
-                    
-            command = HighlightCommand(self.pdf_doc, selected_rects, page_num, self.highlight_color)
-            self.command_history.execute(command)
+        if selected_rects and not self._apply_highlight_command(
+                selected_rects, page_num, self.highlight_color):
+            return
         
         # Clear the selection after highlighting
-        page_widget.selection_start = None
-        page_widget.selection_end = None
-        page_widget.update()
+        page_widget.clear_selection()
+        
+        # Rerender only the page that gained highlights
+        self._render_single_page(page_num)
+        
+    def _apply_highlight_command(self, rects, page_num, color):
+        """Execute a HighlightCommand; return False if the user cancels it"""
+        # Check if we'll lose redo history and if we should show the warning
+        if (self.command_history.will_lose_redo_history() and 
+            not self.settings.value("hide_redo_warning", False, type=bool)):
+            # Create message box with checkbox
+            msg_box = QMessageBox(self)
+            msg_box.setIcon(QMessageBox.Warning)
+            msg_box.setWindowTitle('Warning')
+            msg_box.setText('Creating a new highlight here will clear your redo history.')
+            msg_box.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+            msg_box.setDefaultButton(QMessageBox.No)
+            
+            # Add checkbox
+            checkbox = QCheckBox("Don't show this warning again")
+            msg_box.setCheckBox(checkbox)
+            
+            reply = msg_box.exec_()
+            
+            # Save checkbox state if user clicked Yes
+            if reply == QMessageBox.Yes and checkbox.isChecked():
+                self.settings.setValue("hide_redo_warning", True)
+                self.settings.sync()
+            
+            if reply == QMessageBox.No:
+                return False
+                
+        command = HighlightCommand(self.pdf_doc, rects, page_num, color)
+        self.command_history.execute(command)
         
         # Update undo/redo action states
+        self._session_dirty = True
         self.update_undo_redo_actions()
-        
-        # Rerender to show highlights
-        self.render_pdf()
+        return True
     
     def perform_search(self):
         """Search through document text"""
-        query = self.search_field.text().lower()
+        query = self.search_field.text()
         self.search_results = []
+        if not query:
+            return
         
-        for page_num, text in enumerate(self.pdf_doc.page_text_data):
-            if query in text.lower():
-                # Find all matches and their positions
-                start_idx = 0
-                while True:
-                    idx = text.lower().find(query, start_idx)
-                    if idx == -1:
-                        break
-                    self.search_results.append((page_num, idx, idx+len(query)))
-                    start_idx = idx + len(query)
+        # The word index narrows the pages, then MuPDF finds the hits on each
+        # one and returns their rects directly
+        for page_num in self.pdf_doc.candidate_pages(query.lower()):
+            with fitz_lock:
+                rects = self.pdf_doc.doc[page_num].search_for(query)
+            self.search_results.extend((page_num, rect) for rect in rects)
         
         if self.search_results:
             self.current_search_index = 0
             self.highlight_search_result()
-        self.render_pdf()  # Rerender to show search highlights
 
     def highlight_search_result(self):
         """Highlight current search result"""
         if self.search_results:
-            page_num, start_idx, end_idx = self.search_results[self.current_search_index]
-            self.highlight_selected_text()
+            page_num, rect = self.search_results[self.current_search_index]
+            if not self._apply_highlight_command([rect], page_num, self.search_highlight_color):
+                return
             self.current_selection_info = {
-                'text': self.pdf_doc.page_text_data[page_num][start_idx:end_idx],
+                'text': self.search_field.text(),
                 'page_num': page_num
             }
-            self.render_pdf()
+            self._render_single_page(page_num)
 
     def closeEvent(self, event):
         """Save state on window close"""
@@ -482,43 +604,8 @@ class MainWindow(QMainWindow):
                 if current_path and os.path.exists(current_path):
                     self.settings.setValue("last_file", current_path)
                     
-                    # Save annotations and command history
-                    try:
-                        # Save annotations
-                        annotations_data = []
-                        for ann in self.pdf_doc.annotations:
-                            color = ann['color']
-                            color_dict = {
-                                'r': color.red(),
-                                'g': color.green(),
-                                'b': color.blue(),
-                                'a': color.alpha()
-                            }
-                            
-                            rect = ann['rect']
-                            rect_dict = {
-                                'x0': rect.x0,
-                                'y0': rect.y0,
-                                'x1': rect.x1,
-                                'y1': rect.y1
-                            }
-                            
-                            ann_dict = {
-                                'type': ann['type'],
-                                'page': ann['page'],
-                                'color': color_dict,
-                                'rect': rect_dict
-                            }
-                            annotations_data.append(ann_dict)
-                        
-                        self.settings.setValue("annotations", json.dumps(annotations_data))
-                        
-                        # Save command history
-                        command_history = self.command_history.to_dict()
-                        self.settings.setValue("command_history", json.dumps(command_history))
-                        
-                    except Exception as e:
-                        print(f"Warning: Could not save annotations or history: {e}")
+                    # Save annotations and command history if they changed
+                    self._flush_session()
         except Exception as e:
             print(f"Warning: Error saving session: {e}")
             try:
@@ -526,6 +613,159 @@ class MainWindow(QMainWindow):
             except:
                 pass
 
+    def _flush_session(self):
+        """Write annotations and command history if they changed"""
+        if not self._session_dirty or not self.pdf_doc.doc:
+            return
+            
+        pdf_path = self.pdf_doc.doc.name
+        history = self.command_history
+        if not (self.pdf_doc.annotations or history.undo_stack or history.redo_stack):
+            # Nothing to keep; don't leave a file behind for a viewed PDF,
+            # and drop one whose annotations were all removed
+            for path in _sidecar_paths(pdf_path):
+                if os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Warning: Could not remove session file: {e}")
+            self._session_dirty = False
+            return
+            
+        try:
+            # Keep the file path in step with the annotations written for it
+            self.settings.setValue("last_file", self.pdf_doc.doc.name)
+            
+            # Save annotations
+            annotations_data = []
+            for ann in self.pdf_doc.annotations:
+                color = ann.color
+                color_dict = {
+                    'r': color.red(),
+                    'g': color.green(),
+                    'b': color.blue(),
+                    'a': color.alpha()
+                }
+                
+                rect = ann.rect
+                rect_dict = {
+                    'x0': rect.x0,
+                    'y0': rect.y0,
+                    'x1': rect.x1,
+                    'y1': rect.y1
+                }
+                
+                ann_dict = {
+                    'type': ann.type,
+                    'page': ann.page,
+                    'color': color_dict,
+                    'rect': rect_dict
+                }
+                annotations_data.append(ann_dict)
+            
+            # Annotations and command history go to a sidecar file next to
+            # the PDF; written to a temporary file first and swapped in, so
+            # a crash mid-write never leaves a truncated sidecar behind
+            beside, app_data = _sidecar_paths(pdf_path)
+            if os.access(os.path.dirname(os.path.abspath(beside)), os.W_OK):
+                sidecar = beside
+            else:
+                sidecar = app_data
+                os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+            tmp_path = sidecar + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+                json.dump({
+                    'annotations': annotations_data,
+                    'history': self.command_history.to_dict()
+                }, tmp_file, separators=(',', ':'), ensure_ascii=False)
+            os.replace(tmp_path, sidecar)
+            self._session_dirty = False
+            
+            # Older versions kept one session in QSettings; once it has
+            # been written to the file above, stop restoring it
+            if self._legacy_session:
+                self.settings.remove("annotations")
+                self.settings.remove("command_history")
+                self._legacy_session = False
+            
+        except Exception as e:
+            print(f"Warning: Could not save annotations or history: {e}")
+
+    def _read_session_data(self, path):
+        """Return (annotations, command history) saved for a PDF"""
+        for sidecar in _sidecar_paths(path):
+            if not os.path.exists(sidecar):
+                continue
+            try:
+                with open(sidecar, encoding="utf-8") as sidecar_file:
+                    data = json.load(sidecar_file)
+                return data.get('annotations'), data.get('history')
+            except (OSError, ValueError) as e:
+                print(f"Error reading session file: {e}")
+                return None, None
+                
+        annotations_data = command_history = None
+        if path != self.settings.value("last_file"):
+            return annotations_data, command_history
+        try:
+            if self.settings.contains("annotations"):
+                annotations_data = json.loads(self.settings.value("annotations"))
+            if self.settings.contains("command_history"):
+                command_history = json.loads(self.settings.value("command_history"))
+        except (TypeError, ValueError) as e:
+            print(f"Error reading saved session: {e}")
+        if annotations_data or command_history:
+            # Move the old session into a sidecar file on the next write
+            self._legacy_session = True
+            self._session_dirty = True
+        return annotations_data, command_history
+
+    def _restore_session(self, path):
+        """Load the annotations and command history saved for a PDF"""
+        annotations_data, command_history = self._read_session_data(path)
+        
+        # Restore annotations
+        if annotations_data is not None:
+            try:
+                # Nearly all highlights share a handful of colours,
+                # so build one QColor per distinct colour
+                colors = {}
+                for ann_dict in annotations_data:
+                    # Reconstruct QColor
+                    color_dict = ann_dict['color']
+                    color_key = (
+                        color_dict['r'],
+                        color_dict['g'],
+                        color_dict['b'],
+                        color_dict['a']
+                    )
+                    color = colors.get(color_key)
+                    if color is None:
+                        color = colors[color_key] = QColor(*color_key)
+                    
+                    # Reconstruct fitz.Rect
+                    rect_dict = ann_dict['rect']
+                    rect = fitz.Rect(
+                        rect_dict['x0'],
+                        rect_dict['y0'],
+                        rect_dict['x1'],
+                        rect_dict['y1']
+                    )
+                    
+                    # Add annotation
+                    self.pdf_doc.add_highlight(rect, ann_dict['page'], color)
+            except Exception as e:
+                print(f"Error restoring annotations: {e}")
+        
+        # Restore command history
+        if command_history is not None:
+            try:
+                self.command_history.load_from_dict(command_history, self.pdf_doc)
+                # Update UI state for undo/redo buttons
+                self.update_undo_redo_actions()
+            except Exception as e:
+                print(f"Error restoring command history: {e}")
+
     def load_last_session(self):
         """Load previous session state"""
         try:
@@ -544,80 +784,72 @@ class MainWindow(QMainWindow):
                     print(f"Error restoring zoom level: {e}")
                     self.zoom_level = 1.5  # Reset to default if invalid
             
-            # Restore last opened file
+            # Reopen the last file once the window is up, so it paints first
             if self.settings.contains("last_file"):
-                last_file = self.settings.value("last_file")
-                if os.path.exists(last_file):
-                    if self.pdf_doc.open(last_file):
-                        # Restore annotations
-                        if self.settings.contains("annotations"):
-                            try:
-                                annotations_data = json.loads(self.settings.value("annotations"))
-                                for ann_dict in annotations_data:
-                                    # Reconstruct QColor
-                                    color_dict = ann_dict['color']
-                                    color = QColor(
-                                        color_dict['r'],
-                                        color_dict['g'],
-                                        color_dict['b'],
-                                        color_dict['a']
-                                    )
-                                    
-                                    # Reconstruct fitz.Rect
-                                    rect_dict = ann_dict['rect']
-                                    rect = fitz.Rect(
-                                        rect_dict['x0'],
-                                        rect_dict['y0'],
-                                        rect_dict['x1'],
-                                        rect_dict['y1']
-                                    )
-                                    
-                                    # Add annotation
-                                    self.pdf_doc.add_highlight(rect, ann_dict['page'], color)
-                            except Exception as e:
-                                print(f"Error restoring annotations: {e}")
-                                
-                        # Restore command history
-                        if self.settings.contains("command_history"):
-                            try:
-                                command_history = json.loads(self.settings.value("command_history"))
-                                self.command_history.load_from_dict(command_history, self.pdf_doc)
-                                # Update UI state for undo/redo buttons
-                                self.update_undo_redo_actions()
-                            except Exception as e:
-                                print(f"Error restoring command history: {e}")
-                        
-                        # Render the document
-                        self.render_pdf()
-                        
-                        # Restore scroll position if scroll_area exists
-                        if hasattr(self, 'scroll_area') and self.settings.contains("scroll_position"):
-                            try:
-                                scroll_pos = int(self.settings.value("scroll_position"))
-                                self.scroll_area.verticalScrollBar().setValue(scroll_pos)
-                            except (ValueError, TypeError) as e:
-                                print(f"Error restoring scroll position: {e}")
+                QTimer.singleShot(0, self._resume_last_file)
         except Exception as e:
             print(f"Error loading session: {e}")
             self.zoom_level = 1.5
+    
+    def _resume_last_file(self):
+        """Reopen the last session's file with its annotations and history"""
+        try:
+            last_file = self.settings.value("last_file")
+            if not last_file or not os.path.exists(last_file):
+                return
+            
+            # Don't make the user wait on a large file they may not want back
+            if os.path.getsize(last_file) > _RESUME_PROMPT_BYTES:
+                reply = QMessageBox.question(
+                    self, 'Resume Session',
+                    f'Reopen {os.path.basename(last_file)} from your last session?',
+                    QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+                if reply != QMessageBox.Yes:
+                    return
+            
+            if self.pdf_doc.open(last_file):
+                self._restore_session(last_file)
+                
+                # Render the document
+                self.render_pdf()
+                        
+                # Restore scroll position if scroll_area exists
+                if hasattr(self, 'scroll_area') and self.settings.contains("scroll_position"):
+                    try:
+                        scroll_pos = int(self.settings.value("scroll_position"))
+                        self.scroll_area.verticalScrollBar().setValue(scroll_pos)
+                    except (ValueError, TypeError) as e:
+                        print(f"Error restoring scroll position: {e}")
+        except Exception as e:
+            print(f"Error resuming session: {e}")
 
     def undo_last_action(self):
         """Handle undo logic"""
         if self.command_history.undo():
-            print("Undid last action")  # Debug print
+            logger.debug("Undid last action")
+            self._session_dirty = True
             self.update_undo_redo_actions()
-            # Force a complete rerender to show changes
-            if self.pdf_doc.doc:
-                self.render_pdf()
+            # The undone command now sits on top of the redo stack
+            self._refresh_command_page(self.command_history.redo_stack[-1])
         
     def redo_last_action(self):
         """Handle redo logic"""
         if self.command_history.redo():
-            print("Redid last action")  # Debug print
+            logger.debug("Redid last action")
+            self._session_dirty = True
             self.update_undo_redo_actions()
-            # Force a complete rerender to show changes
-            if self.pdf_doc.doc:
-                self.render_pdf()
+            # The redone command now sits on top of the undo stack
+            self._refresh_command_page(self.command_history.undo_stack[-1])
+            
+    def _refresh_command_page(self, command):
+        """Rerender the page a command changed, or everything if unknown"""
+        if not self.pdf_doc.doc:
+            return
+        page_num = getattr(command, 'page_num', None)
+        if page_num is None:
+            self.render_pdf()
+        else:
+            self._render_single_page(page_num)
             
     def update_undo_redo_actions(self):
         """Update the enabled state of undo/redo actions"""
@@ -626,4 +858,4 @@ class MainWindow(QMainWindow):
         
         self.undo_action.setEnabled(can_undo)
         self.redo_action.setEnabled(can_redo)
-        print(f"Updated action states - Can undo: {can_undo}, Can redo: {can_redo}")  # Debug print 
\ No newline at end of file
+        logger.debug("Updated action states - Can undo: %s, Can redo: %s", can_undo, can_redo) 
\ No newline at end of file
@@ -0,0 +1,88 @@
+import logging
+import threading
+
+import fitz  # PyMuPDF
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from core.pdf_document import extract_page_spans, fitz_lock
+from ui.pdf_display_widget import build_text_layout
+
+logger = logging.getLogger(__name__)
+
+# One document handle per pool thread; workers never touch the GUI
+# thread's document, whose pages gain highlight annotations before saving
+_thread_docs = threading.local()
+
+def _thread_document(path, cache_key):
+    """Return this thread's handle on the PDF at path; call with fitz_lock held"""
+    # Matching on cache_key rather than the path reopens a file changed on disk
+    doc = getattr(_thread_docs, 'doc', None)
+    if doc is None or _thread_docs.key != cache_key:
+        if doc is not None:
+            doc.close()
+        doc = fitz.open(path)
+        _thread_docs.doc = doc
+        _thread_docs.key = cache_key
+    return doc
+
+class RenderSignals(QObject):
+    """Carries finished renders from pool threads back to the GUI thread"""
+    # Render generation, page number, rendered image
+    finished = pyqtSignal(int, int, QImage)
+    failed = pyqtSignal(int, int)  # Render generation, page number
+    # Render generation, page number, (bboxes, texts, char_x), TextLayout
+    textReady = pyqtSignal(int, int, object, object)
+    textFailed = pyqtSignal(int, int)  # Render generation, page number
+
+class PageRenderTask(QRunnable):
+    """Rasterize one bare page on a QThreadPool thread"""
+    def __init__(self, signals, path, cache_key, page_num, zoom, generation):
+        super().__init__()
+        self.signals = signals
+        self.path = path
+        self.cache_key = cache_key
+        self.page_num = page_num
+        self.zoom = zoom
+        self.generation = generation
+    
+    def run(self):
+        try:
+            with fitz_lock:
+                page = _thread_document(self.path, self.cache_key)[self.page_num]
+                pix = page.get_pixmap(matrix=fitz.Matrix(self.zoom, self.zoom), alpha=False)
+                
+                # Converting to the native 32-bit layout here does the RGB888
+                # conversion QPixmap.fromImage would otherwise do on the GUI
+                # thread, and detaches the image from pix's buffer in the same
+                # copy, so pix can be released while the lock is still held
+                image = QImage(pix.samples_ptr, pix.width, pix.height, pix.stride,
+                               QImage.Format_RGB888).convertToFormat(QImage.Format_RGB32)
+                del pix
+        except Exception:
+            logger.exception("Error rendering page %d", self.page_num)
+            self.signals.failed.emit(self.generation, self.page_num)
+            return
+        self.signals.finished.emit(self.generation, self.page_num, image)
+
+class PageTextTask(QRunnable):
+    """Extract one page's text spans and lay them out on a pool thread"""
+    def __init__(self, signals, path, cache_key, page_num, zoom, generation):
+        super().__init__()
+        self.signals = signals
+        self.path = path
+        self.cache_key = cache_key
+        self.page_num = page_num
+        self.zoom = zoom
+        self.generation = generation
+        
+    def run(self):
+        try:
+            with fitz_lock:
+                spans = extract_page_spans(_thread_document(self.path, self.cache_key)[self.page_num])
+            layout = build_text_layout(*spans, self.zoom)
+        except Exception:
+            logger.exception("Error extracting text of page %d", self.page_num)
+            self.signals.textFailed.emit(self.generation, self.page_num)
+            return
+        self.signals.textReady.emit(self.generation, self.page_num, spans, layout)
\ No newline at end of file
@@ -1,17 +1,136 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
 from PyQt5.QtWidgets import QLabel
-from PyQt5.QtGui import QPainter, QColor
-from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPainter, QPainterPath, QBrush, QColor, QPixmap, QPixmapCache
+from PyQt5.QtCore import Qt, QTimer, QRect, pyqtSignal
+
+_SPACE_RE = re.compile(r'\s')
+
+# Built once; paintEvent runs on every drag step
+_SELECTION_BRUSH = QBrush(QColor(0, 120, 215, 128))  # Semi-transparent blue
+
+@dataclass(slots=True, eq=False)
+class TextLayout:
+    """A page's text spans scaled to one zoom level, as parallel arrays"""
+    text: str  # All span text joined; character indices point into it
+    space_idx: array  # Sorted offsets of whitespace in text
+    span_starts: array  # Start offset of each span in text
+    span_lengths: array
+    span_y: array
+    span_height: array
+    span_right: array
+    char_x: array  # Left edge of each character in text
+    line_tops: list  # Top edge of each line, ascending
+    line_bottoms: array
+    line_spans: list  # Span indices of each line, left to right
+    line_span_x: list  # Left edge of each span in line_spans order
+
+def build_text_layout(bboxes, texts, char_x, zoom=1.0):
+    """Build a TextLayout from a page's spans as PyMuPDF gives them"""
+    kept = []
+    starts, lengths = array('l'), array('l')
+    xs, ys, bottoms = array('d'), array('d'), array('d')
+    heights, rights = array('d'), array('d')
+    offset = 0
+    for i, text in enumerate(texts):
+        if not text:
+            continue
+        x0, y0, x1, y1 = bboxes[4 * i:4 * i + 4]
+        # Clamp to the widget and keep every span at least a pixel big
+        x = max(0, x0 * zoom)
+        y = max(0, y0 * zoom)
+        width = max(1, (x1 - x0) * zoom)
+        height = max(1, (y1 - y0) * zoom)
+        starts.append(offset)
+        lengths.append(len(text))
+        xs.append(x)
+        ys.append(y)
+        bottoms.append(y + height)
+        heights.append(height)
+        rights.append(x + width)
+        kept.append(text)
+        offset += len(text)
+        
+    text = ''.join(kept)
+    # Word boundaries are looked up by bisecting the whitespace offsets
+    space_idx = array('l', (m.start() for m in _SPACE_RE.finditer(text)))
+    # Empty spans hold no characters, so char_x already lines up with
+    # the joined text
+    scaled_char_x = array('d', [max(0, x * zoom) for x in char_x])
+    return TextLayout(text, space_idx, starts, lengths, ys, heights, rights,
+                      scaled_char_x, *_line_index(xs, ys, heights, bottoms))
+
+def _line_index(xs, ys, heights, bottoms):
+    """Group spans into lines the same way selection_line_rects does"""
+    line_tops, line_bottoms = [], array('d')
+    line_spans, line_span_x = [], []
+    line_y = None
+    for span_idx in sorted(range(len(ys)), key=lambda i: (ys[i], xs[i])):
+        y = ys[span_idx]
+        if line_y is None or abs(y - line_y) > heights[span_idx] * 0.5:
+            line_y = y
+            line_tops.append(y)
+            line_bottoms.append(bottoms[span_idx])
+            line_spans.append([])
+        else:
+            line_bottoms[-1] = max(line_bottoms[-1], bottoms[span_idx])
+        line_spans[-1].append(span_idx)
+        
+    # Spans were visited top to bottom; order each line left to right
+    for spans in line_spans:
+        spans.sort(key=xs.__getitem__)
+        line_span_x.append([xs[i] for i in spans])
+        
+    return line_tops, line_bottoms, line_spans, line_span_x
+
+_EMPTY_LAYOUT = build_text_layout(array('d'), [], array('d'))
 
 class PDFDisplayWidget(QLabel):
     """Custom widget for handling PDF page display and text selection"""
+    textSelected = pyqtSignal(str, int)  # Selected text, page number
+    renderRequested = pyqtSignal(int)  # Page number whose pixmap was evicted
+    
     def __init__(self, parent=None, page_num=0):
         super().__init__(parent)
         self.page_num = page_num
         self.selection_start = None
         self.selection_end = None
         self.is_selecting = False
-        self.text_blocks = []  # Will store character-level text positions
-        self.selected_chars = set()  # Track selected character indices
+        self.text = ""  # All span text joined; character indices point into it
+        # Span geometry as parallel arrays of C doubles, indexed by span
+        self._span_starts = array('l')  # Start offset of each span in self.text
+        self._span_lengths = array('l')
+        self._span_y = array('d')
+        self._span_height = array('d')
+        self._span_right = array('d')
+        self._char_x = array('d')  # Left edge of each character in self.text
+        self._space_idx = array('l')  # Sorted offsets of whitespace in self.text
+        # Spans grouped into text lines: lines ordered by top edge, and each
+        # line's spans ordered by left edge, for bisecting on both axes
+        self._line_tops = []
+        self._line_bottoms = array('d')
+        self._line_spans = []  # Span indices of each line, left to right
+        self._line_span_x = []  # Left edge of each span in _line_spans order
+        self._selection_path = QPainterPath()  # Selected line rects, for painting
+        self._selection_bbox = QRect()  # Area the painted selection covers
+        # The bare page image stays in QPixmapCache and is looked up when
+        # painting. A page with highlights keeps its own copy with them drawn
+        # in, outside the cache, so it never pushes other pages' images out.
+        self._cache_key = None
+        self._page_image = None  # Held here only when QPixmapCache refused it
+        self._highlights = []  # (QRectF, QColor) pairs in widget coordinates
+        self._highlight_key = None  # Identifies the highlights, if any
+        self._composite = None  # Page with highlights drawn in, built on paint
+        
+        # Drag-selection updates are coalesced to about one per frame
+        self._pending_pos = None
+        self._last_hit = None  # QRect of the character the drag last hit
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(16)
+        self._flush_timer.timeout.connect(self._flush_selection)
         
         # Enable mouse tracking for hover effects
         self.setMouseTracking(True)
@@ -31,6 +150,7 @@ class PDFDisplayWidget(QLabel):
                     self.selection_start = char_idx
                     self.selection_end = char_idx
                 self.is_selecting = True
+                self._last_hit = None
                 self.update_selection()
             
     def mouseDoubleClickEvent(self, event):
@@ -46,118 +166,220 @@ class PDFDisplayWidget(QLabel):
     
     def mouseMoveEvent(self, event):
         if self.is_selecting:
-            pos = event.pos()
-            char_idx = self.find_nearest_char(pos)
-            if char_idx is not None:
-                self.selection_end = char_idx
-                self.update_selection()
+            # Only remember the latest position; the timer applies it
+            self._pending_pos = event.pos()
+            if not self._flush_timer.isActive():
+                self._flush_timer.start()
     
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.LeftButton:
-            self.is_selecting = False
+            # Apply the final drag position before ending the selection
+            self._flush_timer.stop()
+            self._flush_selection()
+            if self.is_selecting:
+                self.is_selecting = False
+                # The drag is over; report only the text it ended on
+                self._emit_selection()
+            
+    def _flush_selection(self):
+        """Extend the selection to the most recent drag position"""
+        pos = self._pending_pos
+        self._pending_pos = None
+        if pos is None or not self.is_selecting:
+            return
+        # Most drag steps stay over the character hit last time
+        if self._last_hit is not None and self._last_hit.contains(pos):
+            return
+        char_idx = self.find_nearest_char(pos)
+        if char_idx is not None:
+            self._last_hit = self.char_rect(char_idx)
+            if char_idx != self.selection_end:
+                self.selection_end = char_idx
+                self.update_selection()
     
     def find_nearest_char(self, pos):
         """Find the character index closest to the given position"""
-        if not self.text_blocks:
+        if not self.text:
+            return None
+            
+        px, py = pos.x(), pos.y()
+        
+        # The cursor's line is the last one starting above it; a taller
+        # line just before it may still reach down to the cursor
+        line = bisect_right(self._line_tops, py) - 1
+        if line >= 0 and py > self._line_bottoms[line]:
+            line -= 1
+            if line >= 0 and py > self._line_bottoms[line]:
+                return None
+        if line < 0:
             return None
             
+        spans = self._line_spans[line]
+        char_x = self._char_x
+        
+        # Only the span starting left of the cursor and the one after it
+        # can hold the nearest character
+        first = max(bisect_right(self._line_span_x[line], px) - 1, 0)
         min_dist = float('inf')
         nearest_idx = None
-        
-        for idx, block in enumerate(self.text_blocks):
-            rect = block['rect']
-            # Check if position is within the vertical bounds of this line
-            if pos.y() >= rect['y'] and pos.y() <= rect['y'] + rect['height']:
-                # Calculate horizontal distance to character
-                char_center_x = rect['x'] + rect['width'] / 2
-                dist = abs(pos.x() - char_center_x)
-                if dist < min_dist:
-                    min_dist = dist
-                    nearest_idx = idx
-                    
+        for span_idx in spans[first:first + 2]:
+            # The nearest character is the one under the cursor, clamped
+            # to the span's ends
+            start = self._span_starts[span_idx]
+            stop = start + self._span_lengths[span_idx]
+            char_idx = max(bisect_right(char_x, px, start, stop) - 1, start)
+            center = (char_x[char_idx] + self._char_right(char_idx, span_idx)) / 2
+            dist = abs(px - center)
+            if dist < min_dist:
+                min_dist = dist
+                nearest_idx = char_idx
+                
         return nearest_idx
+        
+    def _char_right(self, char_idx, span_idx):
+        """Return the right edge of a character: the next one's left edge"""
+        if char_idx + 1 < self._span_starts[span_idx] + self._span_lengths[span_idx]:
+            return self._char_x[char_idx + 1]
+        return self._span_right[span_idx]
+    
+    def char_rect(self, char_idx):
+        """Return the screen rect of a character"""
+        span_idx = bisect_right(self._span_starts, char_idx) - 1
+        x = self._char_x[char_idx]
+        width = self._char_right(char_idx, span_idx) - x
+        return QRect(int(x), int(self._span_y[span_idx]),
+                     max(1, int(width)), max(1, int(self._span_height[span_idx])))
     
     def find_word_boundaries(self, char_idx):
         """Find word boundaries around the given character index"""
-        if char_idx is None or not self.text_blocks:
+        if char_idx is None or not self.text:
             return None, None
             
-        # Find start of word
-        start = char_idx
-        while start > 0 and not self.text_blocks[start-1]['text'].isspace():
-            start -= 1
+        spaces = self._space_idx
+        
+        # Start of word: just after the last whitespace before char_idx
+        k = bisect_left(spaces, char_idx)
+        start = spaces[k - 1] + 1 if k else 0
             
-        # Find end of word
-        end = char_idx
-        while end < len(self.text_blocks)-1 and not self.text_blocks[end+1]['text'].isspace():
-            end += 1
+        # End of word: just before the first whitespace after char_idx
+        k = bisect_right(spaces, char_idx)
+        end = spaces[k] - 1 if k < len(spaces) else len(self.text) - 1
             
         return start, end
     
-    def paintEvent(self, event):
-        super().paintEvent(event)
+    def set_page_image(self, cache_key, highlights, pixmap=None):
+        """Show the page image under cache_key, or pixmap if given, with highlights on top"""
+        if pixmap is not None:
+            self._page_image = pixmap
+        elif cache_key != self._cache_key:
+            self._page_image = None
+        highlight_key = None
+        if highlights:
+            # Keyed on the highlights themselves, so showing the same page
+            # and highlights again reuses the composite
+            content = tuple((rect.x(), rect.y(), rect.width(), rect.height(), color.rgba())
+                            for rect, color in highlights)
+            highlight_key = hash(content)
+        if cache_key != self._cache_key or highlight_key != self._highlight_key:
+            self._composite = None
+        self._cache_key = cache_key
+        self._highlights = highlights
+        self._highlight_key = highlight_key
+        self.update()
         
-        if self.selection_start is not None and self.selection_end is not None:
-            painter = QPainter(self)
-            painter.setRenderHint(QPainter.Antialiasing)
-            
-            # Set selection highlight color
-            highlight_color = QColor(0, 120, 215, 128)  # Semi-transparent blue
-            painter.setBrush(highlight_color)
-            painter.setPen(Qt.NoPen)
-            
-            # Get selection range
-            start_idx = min(self.selection_start, self.selection_end)
-            end_idx = max(self.selection_start, self.selection_end)
-            
-            # Group characters by line (using y-coordinate)
-            current_line = []
-            current_y = None
-            
-            # Process all selected characters
-            for i in range(start_idx, end_idx + 1):
-                if i >= len(self.text_blocks):
-                    break
-                    
-                rect = self.text_blocks[i]['rect']
-                y = int(rect['y'])
-                
-                # If this is a new line or the first character
-                if current_y is None or abs(y - current_y) > rect['height'] * 0.5:
-                    # Draw the previous line if it exists
-                    if current_line:
-                        self._draw_line_highlight(painter, current_line)
-                    # Start a new line
-                    current_line = [rect]
-                    current_y = y
-                else:
-                    # Add to current line
-                    current_line.append(rect)
+    def clear_page_image(self):
+        """Drop the page image, leaving an empty placeholder of the same size"""
+        self._cache_key = None
+        self._page_image = None
+        self._highlights = []
+        self._highlight_key = None
+        self._composite = None
+        self.update()
+    
+    def holds_page_image(self, cache_key):
+        """Whether the widget keeps its own image for cache_key"""
+        return self._page_image is not None and self._cache_key == cache_key
+        
+    def _page_pixmap(self):
+        """Return the page with its highlights drawn in, or None if evicted"""
+        if self._composite is not None:
+            return self._composite
             
-            # Draw the last line
-            if current_line:
-                self._draw_line_highlight(painter, current_line)
+        base = self._page_image
+        if base is None:
+            base = QPixmapCache.find(self._cache_key)
+        if base is None or base.isNull():
+            return None
+        if self._highlight_key is None:
+            return base
             
-            painter.end()
+        composite = QPixmap(base)
+        painter = QPainter(composite)
+        # Multiplying looks like a PDF highlight annotation
+        painter.setCompositionMode(QPainter.CompositionMode_Multiply)
+        for rect, color in self._highlights:
+            painter.fillRect(rect, color)
+        painter.end()
+        self._composite = composite
+        return composite
     
-    def _draw_line_highlight(self, painter, line_rects):
-        """Draw a continuous highlight for a line of text"""
-        if not line_rects:
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        
+        page = None
+        if self._cache_key is not None:
+            page = self._page_pixmap()
+            if page is None:
+                # Evicted from the cache; ask for it to be rendered again
+                self.renderRequested.emit(self.page_num)
+        
+        exposed = event.rect()
+        show_selection = (not self._selection_path.isEmpty()
+                          and self._selection_bbox.intersects(exposed))
+        if page is None and not show_selection:
+            # Nothing to draw here; skip setting up a painter
             return
+        
+        painter = QPainter(self)
+        if page is not None:
+            # Selection changes repaint a small strip; only that part of
+            # the page is copied
+            painter.drawPixmap(exposed, page, exposed)
+        
+        if show_selection:
+            # The path is built when the selection changes; every line is
+            # filled by this one call. The rects are axis-aligned on whole
+            # pixels, so antialiasing would only cost fill rate.
+            painter.fillPath(self._selection_path, _SELECTION_BRUSH)
+        painter.end()
+    
+    def selection_line_rects(self, start_idx, end_idx):
+        """Return one (x, y, width, height) rect per text line in a range"""
+        rects = []
+        if not self._span_starts:
+            return rects
             
-        # Find the bounds of the entire line
-        x_start = min(rect['x'] for rect in line_rects)
-        x_end = max(rect['x'] + rect['width'] for rect in line_rects)
-        y = line_rects[0]['y']
-        height = line_rects[0]['height']
-        
-        # Draw a single rectangle for the entire line
-        painter.drawRect(
-            int(x_start),
-            int(y),
-            int(x_end - x_start),
-            int(height)
-        )
+        current_y = None
+        first = max(bisect_right(self._span_starts, start_idx) - 1, 0)
+        for span_idx in range(first, len(self._span_starts)):
+            start = self._span_starts[span_idx]
+            if start > end_idx:
+                break
+            y = self._span_y[span_idx]
+            height = self._span_height[span_idx]
+            x0 = self._char_x[max(start_idx, start)]
+            x1 = self._char_right(min(end_idx, start + self._span_lengths[span_idx] - 1), span_idx)
+            
+            # If this is a new line or the first span
+            if current_y is None or abs(int(y) - current_y) > height * 0.5:
+                rects.append([x0, y, x1, height])
+                current_y = int(y)
+            else:
+                line = rects[-1]
+                line[0] = min(line[0], x0)
+                line[2] = max(line[2], x1)
+                
+        return [(x0, y, x1 - x0, height) for x0, y, x1, height in rects]
     
     def update_selection(self):
         """Update the selected text based on character selection"""
@@ -165,42 +387,74 @@ class PDFDisplayWidget(QLabel):
             return
             
         # Update visual selection
-        self.update()
+        # Repaint only where the old or new selection lies, not the page
+        self.update(self._recompute_selection_path())
         
-        # Get selected text
+        # Text picked up mid-drag is never used; mouseReleaseEvent
+        # reports the final selection once
+        if not self.is_selecting:
+            self._emit_selection()
+            
+    def _emit_selection(self):
+        """Send the selected text to whoever is listening"""
+        if self.selection_start is None or self.selection_end is None:
+            return
         start_idx = min(self.selection_start, self.selection_end)
         end_idx = max(self.selection_start, self.selection_end)
-        selected_text = ''.join(self.text_blocks[i]['text'] for i in range(start_idx, end_idx + 1))
+        selected_text = self.text[start_idx:end_idx + 1]
+        
+        # Notify whoever is listening (the main window connects once)
+        self.textSelected.emit(selected_text, self.page_num)
+        
+    def clear_selection(self):
+        """Drop the current selection and its highlight"""
+        self.selection_start = None
+        self.selection_end = None
+        self._selection_path = QPainterPath()
+        self.update(self._selection_bbox)
+        self._selection_bbox = QRect()
+        
+    def _recompute_selection_path(self):
+        """Cache the selection's line rects as one path in widget coordinates"""
+        path = QPainterPath()
+        # Winding fill keeps any overlap between lines filled, not cut out
+        path.setFillRule(Qt.WindingFill)
+        if self.selection_start is not None and self.selection_end is not None:
+            start_idx = min(self.selection_start, self.selection_end)
+            end_idx = max(self.selection_start, self.selection_end)
+            for x, y, width, height in self.selection_line_rects(start_idx, end_idx):
+                path.addRect(int(x), int(y), int(width), int(height))
+        self._selection_path = path
         
-        # Get the main window instance and update selection
-        main_window = self.window()
-        if main_window:
-            main_window.handle_text_selection(selected_text, self.page_num)
+        bbox = path.boundingRect().toAlignedRect()
+        dirty = self._selection_bbox.united(bbox)
+        self._selection_bbox = bbox
+        return dirty
     
-    def set_text_blocks(self, blocks):
-        """Set text block data from PyMuPDF"""
-        # Convert blocks to character-level positions
-        char_blocks = []
-        for block in blocks:
-            text = block['text']
-            if not text:
-                continue
-                
-            # Calculate width per character (approximately)
-            char_width = block['rect']['width'] / len(text)
-            
-            # Create a block for each character
-            for i, char in enumerate(text):
-                char_x = block['rect']['x'] + (i * char_width)
-                char_block = {
-                    'text': char,
-                    'rect': {
-                        'x': char_x,
-                        'y': block['rect']['y'],
-                        'width': char_width,
-                        'height': block['rect']['height']
-                    }
-                }
-                char_blocks.append(char_block)
-        
-        self.text_blocks = char_blocks 
\ No newline at end of file
+    def set_text_blocks(self, bboxes, texts, char_x, zoom=1.0):
+        """Set the page's text spans from PyMuPDF; see build_text_layout"""
+        self.set_text_layout(build_text_layout(bboxes, texts, char_x, zoom))
+        
+    def set_text_layout(self, layout):
+        """Install a TextLayout built by build_text_layout"""
+        self.text = layout.text
+        self._space_idx = layout.space_idx
+        self._span_starts = layout.span_starts
+        self._span_lengths = layout.span_lengths
+        self._span_y = layout.span_y
+        self._span_height = layout.span_height
+        self._span_right = layout.span_right
+        self._char_x = layout.char_x
+        self._line_tops = layout.line_tops
+        self._line_bottoms = layout.line_bottoms
+        self._line_spans = layout.line_spans
+        self._line_span_x = layout.line_span_x
+        self._last_hit = None
+        # Span geometry changed (e.g. zoom), so the selection moves with it
+        self.update(self._recompute_selection_path())
+        
+    def clear_text(self):
+        """Drop the page's text layout and any selection in it"""
+        self.selection_start = None
+        self.selection_end = None
+        self.set_text_layout(_EMPTY_LAYOUT)
\ No newline at end of file
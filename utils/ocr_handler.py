@@ -1,30 +1,125 @@
+import os
+import shelve
+
+import fitz  # PyMuPDF
 import pytesseract
 from PIL import Image as PILImage
 
+# Pages with at least this much native text are never OCRed
+_MIN_NATIVE_TEXT = 32
+
+# LSTM engine, text treated as one uniform block
+_TESSERACT_CONFIG = r'--oem 3 --psm 6'
+
+def _render_for_ocr(page, zoom):
+    """Render a page as a one-channel greyscale pixmap"""
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY)
+
+def _pixmap_image(pix):
+    """Wrap a greyscale pixmap's samples in a PIL image without a copy"""
+    # The image borrows pix's buffer, so pix must outlive it
+    return PILImage.frombuffer("L", (pix.width, pix.height), pix.samples_mv,
+                               "raw", "L", pix.stride, 1)
+
+def _otsu_threshold(histogram):
+    """Pick the grey level that best separates ink from paper (Otsu's method)"""
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    sum_bg = weight_bg = 0
+    best_level, best_variance = 0, 0.0
+    for level, count in enumerate(histogram):
+        weight_bg += count
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += level * count
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
 class OCRHandler:
-    def __init__(self):
+    def __init__(self, preprocess=True, zoom=2, cache_path=None):
         self.engine = pytesseract
+        # Binarize images before OCR; turn off to debug recognition issues
+        self.preprocess = preprocess
+        # Render scale for OCR images. Tesseract time grows with the pixel
+        # count, so clean documents can trade a little accuracy for speed
+        # with a lower value such as 1.5.
+        self.zoom = zoom
+        # Optional on-disk store of OCR results, opened on first use
+        self.cache_path = cache_path
+        self._cache = None
+        
+    def _result_cache(self):
+        """Return the shelve of OCR results, or None if caching is off"""
+        if self._cache is None and self.cache_path:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                self._cache = shelve.open(self.cache_path)
+            except Exception as e:
+                print(f"OCR cache unavailable: {e}")
+                self.cache_path = None
+        return self._cache
+        
+    def close(self):
+        """Flush and close the OCR result cache"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+            
+    def prepare_image(self, image):
+        """Convert an image to black-on-white greyscale ready for Tesseract"""
+        if not self.preprocess:
+            return image
+        gray = image if image.mode == "L" else image.convert("L")
+        threshold = _otsu_threshold(gray.histogram())
+        return gray.point([0] * (threshold + 1) + [255] * (255 - threshold))
         
     def process_image(self, image):
         """Process image through OCR engine"""
         try:
-            # Configure OCR for better accuracy
-            custom_config = r'--oem 3 --psm 6'
-            return self.engine.image_to_string(image, config=custom_config)
+            return self.engine.image_to_string(self.prepare_image(image), config=_TESSERACT_CONFIG)
         except Exception as e:
             print(f"OCR Error: {e}")
             return ""
             
-    def process_page(self, page):
-        """Process a PyMuPDF page through OCR"""
+    def process_page(self, page, zoom=None, native_text=None):
+        """Process a PyMuPDF page through OCR, at self.zoom unless given"""
         if not page:
             return ""
+        if zoom is None:
+            zoom = self.zoom
+            
+        # Callers that already extracted the text layer pass it in
+        if native_text is None:
+            native_text = page.get_text()
+        native = native_text.strip()
+        if len(native) >= _MIN_NATIVE_TEXT:
+            return native
+            
+        cache = self._result_cache()
+        key = None
+        if cache is not None:
+            path = page.parent.name
+            try:
+                key = f"{path}:{os.stat(path).st_mtime_ns}:{page.number}:{zoom}"
+            except OSError:
+                pass  # Not backed by a file on disk; nothing to key on
+            if key is not None and key in cache:
+                return cache[key]
             
         try:
-            # Convert page to image for OCR
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # 2x zoom for better OCR
-            img = PILImage.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            return self.process_image(img)
+            # Convert page to image for OCR, zoomed in for better accuracy
+            pix = _render_for_ocr(page, zoom)
+            text = self.process_image(_pixmap_image(pix))
         except Exception as e:
             print(f"Page OCR Error: {e}")
-            return "" 
\ No newline at end of file
+            return ""
+        if key is not None:
+            cache[key] = text
+        return text
\ No newline at end of file